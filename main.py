@@ -2,12 +2,14 @@ from fastapi import FastAPI, UploadFile, File
 from fastapi.responses import JSONResponse, FileResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-import uuid, os, shutil, json
-import requests
+import uuid, os, asyncio
+import httpx
+import orjson
+import aiofiles
 import warnings 
 warnings.filterwarnings('ignore')
-# 從新的檔案導入影片處理函數
-from pose_renderer import render_video_with_pose # 確保 pose_renderer.py 在同一個目錄下
+# 模擬資料與歷史記錄相關函數
+from services import mock_posture, mock_prediction, init_history, append_history, load_history
 
 app = FastAPI()
 
@@ -21,48 +23,120 @@ app.add_middleware(
 
 UPLOAD_DIR = "static/videos"
 PROCESSED_DIR = "static/processed_videos" # Directory for processed videos
-HISTORY_FILE = "history.json"
 
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 os.makedirs(PROCESSED_DIR, exist_ok=True)
 
-# 模擬姿勢資料
-def mock_posture(video_id: str):
-    return {
-        "stride_angle": 42.5,
-        "throwing_angle": 95.3,
-        "arm_symmetry": 88.0,
-        "hip_rotation": 35.2,
-        "elbow_height": 123
-    }
-
-# 模擬模型預測
-def mock_prediction(video_id: str):
-    return {
-        "result": "Good" if video_id.endswith("1") else "Bad",
-        "confidence": 0.92 if video_id.endswith("1") else 0.65
-    }
-
-# 載入歷史
-def load_history():
-    if os.path.exists(HISTORY_FILE):
-        with open(HISTORY_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    return {"history": []}
-
-# 寫入歷史
-def append_history(filename, result):
-    history = load_history()
-    history["history"].append({
-        "timestamp": "2025-06-22",
-        "filename": filename,
-        "result": result
-    })
-    with open(HISTORY_FILE, "w", encoding="utf-8") as f:
-        json.dump(history, f, ensure_ascii=False, indent=2)
+POSE_API_URL = "https://mmpose-api-924124779607.us-central1.run.app/pose_video"
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # 每次讀寫 1 MB
 
+# 共用的非同步 HTTP 客戶端，以 HTTP/2 連線池跨請求重用連線，省去每次上傳的 TCP/TLS 握手 (5 分鐘超時)
+pose_api_client = httpx.AsyncClient(
+    http2=True,
+    timeout=300,
+    limits=httpx.Limits(max_keepalive_connections=20)
+)
 
-POSE_API_URL = "https://mmpose-api-924124779607.us-central1.run.app/pose_video"
+async def warm_up_pose_api_client():
+    # 預先建立到姿勢 API 主機的連線，第一次上傳不必等待握手；失敗不影響服務
+    try:
+        await pose_api_client.head(httpx.URL(POSE_API_URL).copy_with(path="/"), timeout=10)
+    except httpx.HTTPError as e:
+        print(f"Pose API warm-up failed: {e}")
+
+@app.on_event("startup")
+async def start_history():
+    await asyncio.to_thread(init_history)
+
+@app.on_event("startup")
+async def start_pose_api_warm_up():
+    # 在背景執行，冷啟動或無法連線的姿勢 API 不會延遲應用啟動
+    app.state.pose_api_warm_up = asyncio.create_task(warm_up_pose_api_client())
+
+@app.on_event("shutdown")
+async def close_pose_api_client():
+    app.state.pose_api_warm_up.cancel()
+    await pose_api_client.aclose()
+
+# multipart 檔名參數的跳脫規則 (與 httpx / HTML5 表單編碼一致)
+FORM_PARAM_REPLACEMENTS = {'"': "%22", "\\": "\\\\"}
+FORM_PARAM_REPLACEMENTS.update({chr(c): f"%{c:02X}" for c in range(0x20) if c != 0x1B})
+
+def format_form_param(value: str) -> str:
+    return "".join(FORM_PARAM_REPLACEMENTS.get(char, char) for char in value)
+
+def upload_size(file: UploadFile) -> int:
+    # 一般由表單解析時已得知大小，否則從暫存檔案末端取得
+    if file.size is not None:
+        return file.size
+    position = file.file.tell()
+    size = file.file.seek(0, os.SEEK_END)
+    file.file.seek(position)
+    return size
+
+async def save_and_post_video(file: UploadFile, save_path: str):
+    """
+    分塊讀取上傳內容，每塊先寫入磁碟再送入 multipart 請求主體，
+    一次讀取同時完成保存與上傳，不需在保存後重新讀取檔案。
+    回傳姿勢 API 的 JSON 回應，失敗時回傳包含 error 的 dict。
+    """
+    boundary = uuid.uuid4().hex
+    # 將 'video' 鍵改為 'file'，這是常見的 API 期望的檔案欄位名稱
+    filename = format_form_param(file.filename)
+    part_header = (
+        f'--{boundary}\r\n'
+        f'Content-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+        f'Content-Type: video/mp4\r\n\r\n'
+    ).encode()
+    part_footer = f'\r\n--{boundary}--\r\n'.encode()
+
+    async with aiofiles.open(save_path, "wb") as buffer:
+        async def tee_upload():
+            yield part_header
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                await buffer.write(chunk)
+                yield chunk
+            yield part_footer
+
+        pose_api_response = {}
+        try:
+            response = await pose_api_client.post(
+                POSE_API_URL,
+                content=tee_upload(),
+                headers={
+                    "Content-Type": f"multipart/form-data; boundary={boundary}",
+                    # 預先計算主體長度，避免以 chunked 傳輸編碼送出
+                    "Content-Length": str(len(part_header) + upload_size(file) + len(part_footer)),
+                }
+            )
+            response.raise_for_status()
+            # 以 orjson 直接解析位元組，大型姿勢回應的解析速度遠快於標準庫 json
+            pose_api_response = orjson.loads(response.content)
+            print(f"Pose API Response: {pose_api_response}")
+        except httpx.HTTPError as e:
+            print(f"Error calling pose API: {e}")
+            # 如果有回應內容，打印出來以獲取更多錯誤信息
+            if isinstance(e, httpx.HTTPStatusError):
+                print(f"API Response Content: {e.response.text}")
+            pose_api_response = {"error": True, "message": f"Failed to get pose data from external API: {e}"}
+        except orjson.JSONDecodeError as e:
+            print(f"Error decoding JSON from pose API: {e}")
+            pose_api_response = {"error": True, "message": f"Invalid JSON response from external API: {e}"}
+
+        # API 呼叫失敗時上傳內容可能未被完整讀取，將剩餘部分補寫入磁碟
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            await buffer.write(chunk)
+
+    return pose_api_response
+
+def render_video(video_path: str, pose_api_response: dict) -> str:
+    """
+    在工作執行緒中執行，回傳處理後影片的路徑，失敗時回傳空字串。
+    pose_renderer 會載入 cv2 / av / numba 並探測 GPU 編碼器，延遲到第一次上傳時才導入以加快啟動並降低閒置記憶體；
+    導入同樣在工作執行緒中進行，不會阻塞事件迴圈。
+    """
+    from pose_renderer import render_video_with_pose # 確保 pose_renderer.py 在同一個目錄下
+    return render_video_with_pose(video_path, pose_api_response, PROCESSED_DIR)
 
 # 新增一個健康檢查路由
 @app.get("/health")
@@ -76,40 +150,22 @@ async def health_check():
 @app.post("/upload")
 async def upload(file: UploadFile = File(...)):
     extension = os.path.splitext(file.filename)[1]
-    video_id = str(uuid.uuid4())[:8]
-    original_save_path = os.path.join(UPLOAD_DIR, f"{video_id}{extension}")
-
-    # 保存原始上傳影片
-    with open(original_save_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
-
-    pose_api_response = {}
-    try:
-        # 以二進制模式讀取已保存的影片檔案以進行 POST 請求
-        with open(original_save_path, "rb") as video_file_data:
-            # 將 'video' 鍵改為 'file'，這是常見的 API 期望的檔案欄位名稱
-            files = {'file': (file.filename, video_file_data, 'video/mp4')}
-            response = requests.post(POSE_API_URL, files=files, timeout=300) # 5 分鐘超時
-            response.raise_for_status()
-            pose_api_response = response.json()
-            print(f"Pose API Response: {pose_api_response}")
-    except requests.exceptions.RequestException as e:
-        print(f"Error calling pose API: {e}")
-        # 如果有回應內容，打印出來以獲取更多錯誤信息
-        if hasattr(e, 'response') and e.response is not None:
-            print(f"API Response Content: {e.response.text}")
-        pose_api_response = {"error": True, "message": f"Failed to get pose data from external API: {e}"}
-    except json.JSONDecodeError as e:
-        print(f"Error decoding JSON from pose API: {e}")
-        pose_api_response = {"error": True, "message": f"Invalid JSON response from external API: {e}"}
+    video_id = uuid.uuid4().hex[:8]
+    video_name = f"{video_id}{extension}"
+    original_video_url = f"/static/videos/{video_name}"
+    original_save_path = os.path.join(UPLOAD_DIR, video_name)
 
+    # 邊保存原始上傳影片邊串流至姿勢 API
+    pose_api_response = await save_and_post_video(file, original_save_path)
 
-    # 渲染帶有姿勢資料的影片，現在從 pose_renderer 導入
-    processed_video_local_path = render_video_with_pose(original_save_path, pose_api_response, PROCESSED_DIR)
+    # 渲染帶有姿勢資料的影片 (CPU/IO 密集)，交由執行緒池處理以免阻塞其他請求
+    processed_video_local_path = await asyncio.to_thread(
+        render_video, original_save_path, pose_api_response
+    )
 
     if not processed_video_local_path:
         # 如果處理失敗，則回退到原始影片
-        processed_video_url = f"/static/videos/{video_id}{extension}"
+        processed_video_url = original_video_url
         print("Falling back to original video URL due to processing failure.")
     else:
         # 構建處理過影片的 URL
@@ -117,11 +173,11 @@ async def upload(file: UploadFile = File(...)):
 
     # 模擬預測並寫入歷史記錄 (保留用於儀表板其他部分的現有邏輯)
     result = mock_prediction(video_id)["result"]
-    append_history(f"{video_id}{extension}", result)
+    await append_history(video_name, result)
 
     return {
         "video_id": video_id,
-        "original_video_url": f"/static/videos/{video_id}{extension}",
+        "original_video_url": original_video_url,
         "processed_video_url": processed_video_url,
         "pose_data": pose_api_response
     }
@@ -136,7 +192,7 @@ async def get_prediction(video_id: str):
 
 @app.get("/history")
 async def get_history():
-    return load_history()
+    return await load_history()
 
-# 靜態檔案服務
+# 靜態檔案服務 (本機開發用；正式環境由 nginx 直接提供 /static/，見 deploy/nginx.conf)
 app.mount("/static", StaticFiles(directory="static"), name="static")
@@ -1,9 +1,16 @@
+import av
 import cv2
 import numpy as np
 import os
+import itertools
 import uuid
+from collections import deque
+from fractions import Fraction
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 import warnings 
 warnings.filterwarnings('ignore')
+from numba import njit
 # COCO 關鍵點定義 (17 個點的順序)
 COCO_KEYPOINTS = [
     "nose", "left_eye", "right_eye", "left_ear", "right_ear",
@@ -21,96 +28,367 @@ COCO_CONNECTIONS = [
     (11, 13), (13, 15),
     (12, 14), (14, 16)
 ]
+# 以 NumPy 陣列形式保存連接關係，供向量化篩選使用
+COCO_CONNECTIONS_ARRAY = np.array(COCO_CONNECTIONS, dtype=np.intp)
+# 容器未記錄總幀數時 frame_idx 的上限 (30 fps 約一小時)
+MAX_POSE_FRAMES = 108000
 
-def draw_pose_on_frame(frame, predictions, min_score_thresh=0.5, point_radius=5, line_thickness=2):
+def normalize_predictions(predictions_raw):
     """
-    在單個影片幀上繪製姿態關鍵點和骨架。
+    將 API 回傳的 predictions 統一為「每個人一個 dict」的列表。
+    API 可能回傳 [[person, ...]] 或 [person, ...] 兩種格式。
     """
-    if not predictions:
-        return frame
+    if predictions_raw and isinstance(predictions_raw, list) and predictions_raw[0]:
+        if isinstance(predictions_raw[0], list):
+            return predictions_raw[0]
+        if isinstance(predictions_raw[0], dict):
+            return predictions_raw
+    return []
+
+def build_pose_arrays(api_response_json: dict, max_frames: int = MAX_POSE_FRAMES):
+    """
+    在解碼迴圈開始前，將整份 API 回應一次性轉換為連續的 NumPy 陣列：
+    kps[N, P, K, 2] (int32)、scores[N, P, K] (float32) 與 valid[N, P] (bool)，
+    N 為幀數、P 為單幀最多人數、K 為關鍵點數。缺少資料的幀或人以零填充且 valid 為 False。
+    frame_idx 超出 [0, max_frames) 的幀不會被繪製，直接略過，避免異常索引配置過大的陣列。
+    """
+    # frame_idx 為從 0 開始的連續整數，直接以列表索引，不需建立 dict；
+    # API 可能回傳 3.0 之類的浮點數，先轉為整數
+    indexed_frames = []
+    for frame_data in api_response_json.get('frames', []):
+        frame_idx = int(frame_data['frame_idx'])
+        if not 0 <= frame_idx < max_frames:
+            continue
+        persons = [
+            person for person in normalize_predictions(frame_data.get('predictions', []))
+            if person.get('keypoints') and person.get('keypoint_scores')
+        ]
+        if persons:
+            indexed_frames.append((frame_idx, persons))
+    # 尾端沒有任何人的幀不需保留
+    n_frames = max((frame_idx for frame_idx, _ in indexed_frames), default=-1) + 1
+    frames = [None] * n_frames
+    for frame_idx, persons in indexed_frames:
+        frames[frame_idx] = persons
 
-    for person_prediction in predictions:
-        keypoints_coords = person_prediction.get('keypoints', [])
-        keypoint_scores = person_prediction.get('keypoint_scores', [])
+    present = [persons for persons in frames if persons]
+    max_persons = max((len(persons) for persons in present), default=0)
+    n_keypoints = max(
+        (len(person['keypoints']) for persons in present for person in persons),
+        default=len(COCO_KEYPOINTS)
+    )
 
-        if not keypoints_coords or not keypoint_scores:
+    kps = np.zeros((n_frames, max_persons, n_keypoints, 2), dtype=np.float32)
+    scores = np.zeros((n_frames, max_persons, n_keypoints), dtype=np.float32)
+    valid = np.zeros((n_frames, max_persons), dtype=bool)
+    for frame_idx, persons in enumerate(frames):
+        if not persons:
             continue
+        for person_idx, person in enumerate(persons):
+            coords = np.asarray(person['keypoints'], dtype=np.float32)
+            # 超出關鍵點數量的分數忽略，不足的部分維持 0 (視為不可見)
+            person_scores = person['keypoint_scores'][:len(coords)]
+            kps[frame_idx, person_idx, :len(coords)] = coords
+            scores[frame_idx, person_idx, :len(person_scores)] = person_scores
+            valid[frame_idx, person_idx] = True
+    # 整段影片的座標在連續記憶體上一次性轉為 int32，NumPy 會走 SIMD 向量化的轉型路徑
+    return kps.astype(np.int32), scores, valid
 
-        keypoints_data = []
-        for i, (x, y) in enumerate(keypoints_coords):
-            score = keypoint_scores[i] if i < len(keypoint_scores) else 0.0
-            keypoints_data.append((int(x), int(y), score))
+@lru_cache(maxsize=None)
+def disc_sprite_offsets(radius):
+    """
+    以 cv2.circle 預先光柵化一次半徑為 radius 的實心圓，回傳圓內像素相對圓心的偏移量 (dy, dx)，形狀為 (n, 2) int32。
+    關鍵點圓形的大小固定，繪製時只需依偏移量蓋印，且結果與 cv2.circle 逐像素一致。
+    """
+    sprite = np.zeros((2 * radius + 1, 2 * radius + 1), dtype=np.uint8)
+    cv2.circle(sprite, (radius, radius), radius, 1, -1)
+    return (np.argwhere(sprite) - radius).astype(np.int32)
 
-        for kp_idx, (x, y, score) in enumerate(keypoints_data):
-            if score > min_score_thresh:
-                cv2.circle(frame, (x, y), point_radius, (0, 255, 0), -1)
+@njit(cache=True, nogil=True)
+def _stamp_sprite(frame, cx, cy, offsets, color):
+    height, width = frame.shape[0], frame.shape[1]
+    for i in range(offsets.shape[0]):
+        y = cy + offsets[i, 0]
+        x = cx + offsets[i, 1]
+        if 0 <= y < height and 0 <= x < width:
+            frame[y, x, 0] = color[0]
+            frame[y, x, 1] = color[1]
+            frame[y, x, 2] = color[2]
 
-        for connection in COCO_CONNECTIONS:
-            start_kp_idx = connection[0]
-            end_kp_idx = connection[1]
+@njit(cache=True, nogil=True)
+def _fill_disc(frame, cx, cy, radius, color):
+    height, width = frame.shape[0], frame.shape[1]
+    for dy in range(-radius, radius + 1):
+        y = cy + dy
+        if y < 0 or y >= height:
+            continue
+        for dx in range(-radius, radius + 1):
+            x = cx + dx
+            if x < 0 or x >= width or dx * dx + dy * dy > radius * radius:
+                continue
+            frame[y, x, 0] = color[0]
+            frame[y, x, 1] = color[1]
+            frame[y, x, 2] = color[2]
 
-            if start_kp_idx < len(keypoints_data) and end_kp_idx < len(keypoints_data):
-                x1, y1, s1 = keypoints_data[start_kp_idx]
-                x2, y2, s2 = keypoints_data[end_kp_idx]
+@njit(cache=True, nogil=True)
+def _clip_segment(x1, y1, x2, y2, xmin, ymin, xmax, ymax):
+    # Liang-Barsky 線段裁切，回傳 (是否可見, 裁切後的端點)
+    x1 = float(x1)
+    y1 = float(y1)
+    dx = float(x2) - x1
+    dy = float(y2) - y1
+    t0 = 0.0
+    t1 = 1.0
+    for p, q in ((-dx, x1 - xmin), (dx, xmax - x1), (-dy, y1 - ymin), (dy, ymax - y1)):
+        if p == 0.0:
+            if q < 0.0:
+                return False, 0, 0, 0, 0
+        else:
+            r = q / p
+            if p < 0.0:
+                if r > t1:
+                    return False, 0, 0, 0, 0
+                t0 = max(t0, r)
+            else:
+                if r < t0:
+                    return False, 0, 0, 0, 0
+                t1 = min(t1, r)
+    return (
+        True,
+        int(round(x1 + t0 * dx)), int(round(y1 + t0 * dy)),
+        int(round(x1 + t1 * dx)), int(round(y1 + t1 * dy)),
+    )
 
-                if s1 > min_score_thresh and s2 > min_score_thresh:
-                    cv2.line(frame, (x1, y1), (x2, y2), (0, 255, 255), line_thickness)
+@njit(cache=True, nogil=True)
+def _draw_line(frame, x1, y1, x2, y2, thickness, color):
+    # Bresenham 直線，線寬以每個點上的實心圓近似
+    radius = thickness // 2
+    # 先將線段裁切到畫面 (含線寬) 範圍內，避免端點遠在畫面外時逐點走完整條線
+    visible, x1, y1, x2, y2 = _clip_segment(
+        x1, y1, x2, y2, -radius, -radius, frame.shape[1] - 1 + radius, frame.shape[0] - 1 + radius
+    )
+    if not visible:
+        return
+    dx = abs(x2 - x1)
+    dy = -abs(y2 - y1)
+    sx = 1 if x1 < x2 else -1
+    sy = 1 if y1 < y2 else -1
+    err = dx + dy
+    while True:
+        _fill_disc(frame, x1, y1, radius, color)
+        if x1 == x2 and y1 == y2:
+            break
+        e2 = 2 * err
+        if e2 >= dy:
+            err += dy
+            x1 += sx
+        if e2 <= dx:
+            err += dx
+            y1 += sy
+
+@njit(cache=True, nogil=True)
+def _draw_skeleton_numba(frame, pts, mask, conns, point_offsets, line_thickness, point_color, line_color):
+    for p in range(pts.shape[0]):
+        for k in range(pts.shape[1]):
+            if mask[p, k]:
+                _stamp_sprite(frame, pts[p, k, 0], pts[p, k, 1], point_offsets, point_color)
+        for c in range(conns.shape[0]):
+            start_kp_idx = conns[c, 0]
+            end_kp_idx = conns[c, 1]
+            if mask[p, start_kp_idx] and mask[p, end_kp_idx]:
+                _draw_line(
+                    frame,
+                    pts[p, start_kp_idx, 0], pts[p, start_kp_idx, 1],
+                    pts[p, end_kp_idx, 0], pts[p, end_kp_idx, 1],
+                    line_thickness, line_color
+                )
+
+def draw_pose_arrays(frame, kps, scores, valid, min_score_thresh=0.5, point_radius=5, line_thickness=2):
+    """
+    依預先計算的陣列 (kps[P, K, 2] int32、scores[P, K]、valid[P]) 在單個影片幀上繪製姿態關鍵點和骨架。
+    以單一 numba JIT 核心直接寫入幀緩衝區。
+    """
+    # 只保留兩端點都在關鍵點範圍內的連接
+    conns_in_range = COCO_CONNECTIONS_ARRAY[(COCO_CONNECTIONS_ARRAY < kps.shape[1]).all(axis=1)]
+
+    _draw_skeleton_numba(
+        frame,
+        kps[valid],
+        scores[valid] > min_score_thresh,
+        conns_in_range,
+        disc_sprite_offsets(point_radius), line_thickness,
+        (0, 255, 0), (0, 255, 255)
+    )
     return frame
 
+def draw_pose_on_frame(frame, predictions, min_score_thresh=0.5, point_radius=5, line_thickness=2):
+    """
+    在單個影片幀上繪製姿態關鍵點和骨架。
+    """
+    if not predictions:
+        return frame
+
+    kps, scores, valid = build_pose_arrays({"frames": [{"frame_idx": 0, "predictions": predictions}]})
+    if not len(kps):
+        return frame
+    return draw_pose_arrays(frame, kps[0], scores[0], valid[0], min_score_thresh, point_radius, line_thickness)
+
+# 並行繪製的執行緒數，以及同時在途 (已解碼未寫入) 的幀數上限
+RENDER_WORKERS = os.cpu_count() or 1
+RENDER_QUEUE_SIZE = RENDER_WORKERS * 2
+# 所有渲染請求共用同一個繪製執行緒池，避免每次上傳重新建立執行緒，並限制同時上傳時的總執行緒數
+render_executor = ThreadPoolExecutor(max_workers=RENDER_WORKERS, thread_name_prefix="pose-render")
+
+# 輸出影片編碼設定 (H.264 / yuv420p，moov 移至檔頭以便瀏覽器邊下載邊播放)
+OUTPUT_PIX_FMT = "yuv420p"
+OUTPUT_CONTAINER_OPTIONS = {"movflags": "+faststart"}
+CPU_CODEC, CPU_CODEC_OPTIONS = "libx264", {"preset": "veryfast"}
+GPU_CODEC, GPU_CODEC_OPTIONS = "h264_nvenc", {"preset": "p4"}
+
+def select_output_codec():
+    """
+    有可用的 NVIDIA GPU 時以 NVENC 硬體編碼，將最耗 CPU 的編碼步驟移到 GPU；否則退回 libx264。
+    FFmpeg 編譯時包含 NVENC 不代表執行環境有 GPU，因此實際開啟一次編碼器確認。
+    """
+    if GPU_CODEC in av.codecs_available:
+        try:
+            probe = av.CodecContext.create(GPU_CODEC, "w")
+            probe.width, probe.height = 256, 256
+            probe.pix_fmt = OUTPUT_PIX_FMT
+            probe.time_base = Fraction(1, 30)
+            # 以實際編碼時的參數開啟，確保探測結果與正式編碼一致
+            probe.options = dict(GPU_CODEC_OPTIONS)
+            probe.open()
+            return GPU_CODEC, GPU_CODEC_OPTIONS
+        except av.error.FFmpegError:
+            pass
+    return CPU_CODEC, CPU_CODEC_OPTIONS
+
+OUTPUT_CODEC, OUTPUT_CODEC_OPTIONS = select_output_codec()
+
 def render_video_with_pose(video_path: str, api_response_json: dict, output_dir: str) -> str:
     """
     將姿態偵測結果渲染到原始影片的每一幀上，並將其保存為新的影片檔案。
+    使用 NVENC 編碼失敗時 (例如同時上傳超過 GPU 編碼工作階段上限) 改以 libx264 重新渲染。
+    """
+    if OUTPUT_CODEC == GPU_CODEC:
+        try:
+            return _render_video(video_path, api_response_json, output_dir, GPU_CODEC, GPU_CODEC_OPTIONS)
+        except av.error.FFmpegError as e:
+            print(f"Warning: {GPU_CODEC} encoding failed for {video_path}: {e}. Retrying with {CPU_CODEC}.")
+    try:
+        return _render_video(video_path, api_response_json, output_dir, CPU_CODEC, CPU_CODEC_OPTIONS)
+    except av.error.FFmpegError as e:
+        print(f"Error: Failed while rendering {video_path}: {e}")
+        return ""
+
+def _render_video(video_path, api_response_json, output_dir, codec, codec_options):
+    """
+    以 PyAV (libav) 進行解碼與編碼；每幀在繪製執行緒中轉為 bgr24，並依影片的旋轉資訊轉正，
+    與 cv2.VideoCapture 的自動旋轉 (也就是姿勢 API 的座標系) 一致。
     """
-    cap = cv2.VideoCapture(video_path)
+    try:
+        container = av.open(video_path)
+        in_stream = container.streams.video[0]
+    except (av.error.FFmpegError, IndexError) as e:
+        print(f"Error: Could not open video file {video_path}: {e}")
+        return ""
+    # 讓 libav 以多執行緒解碼
+    in_stream.thread_type = "AUTO"
 
-    if not cap.isOpened():
-        print(f"Error: Could not open video file {video_path}")
+    # 先解碼第一幀以取得旋轉角度 (手機直拍影片通常以 display matrix 標記 ±90 度)
+    decoded_frames = container.decode(in_stream)
+    try:
+        first_frame = next(decoded_frames, None)
+    except av.error.FFmpegError as e:
+        first_frame = None
+        print(f"Error: Could not decode video file {video_path}: {e}")
+    if first_frame is None:
+        print(f"Error: No frames decoded from {video_path}")
+        container.close()
         return ""
+    # np.rot90 的旋轉次數 (逆時針)，與 frame.rotation 的方向相同
+    rotation_steps = round((first_frame.rotation or 0) / 90) % 4
 
-    fps = cap.get(cv2.CAP_PROP_FPS)
-    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    fps = in_stream.average_rate or 30
+    # 輸出幀的時間基準，避免沿用輸入串流的 time_base 造成時間戳錯誤
+    frame_time_base = 1 / Fraction(fps)
+    # yuv420p 需要偶數寬高
+    width = in_stream.codec_context.width // 2 * 2
+    height = in_stream.codec_context.height // 2 * 2
+    if rotation_steps % 2:
+        width, height = height, width
 
-    processed_video_id = str(uuid.uuid4())[:8]
+    processed_video_id = uuid.uuid4().hex[:8]
     # 確保輸出檔案擴展名是 .mp4
     processed_video_filename = f"{processed_video_id}_pose_rendered.mp4"
     processed_video_path = os.path.join(output_dir, processed_video_filename)
 
-    # 嘗試使用 'avc1' 編解碼器以提高兼容性
-    fourcc = cv2.VideoWriter_fourcc(*'avc1') # Changed from 'mp4v' to 'avc1'
-    out = cv2.VideoWriter(processed_video_path, fourcc, fps, (width, height))
-
-    if not out.isOpened():
-        print(f"Error: Could not open video writer for {processed_video_path}. Check codec or path permissions.")
-        print("Common reasons: Missing FFmpeg or incompatible codec. Try 'mp4v' or ensure FFmpeg is installed.")
-        cap.release()
+    try:
+        out = av.open(processed_video_path, "w", options=OUTPUT_CONTAINER_OPTIONS)
+        out_stream = out.add_stream(codec, rate=fps, options=codec_options)
+    except (av.error.FFmpegError, ValueError) as e:
+        print(f"Error: Could not open video writer for {processed_video_path}: {e}")
+        print(f"Common reasons: PyAV built without the {codec} encoder or missing path permissions.")
+        container.close()
+        if isinstance(e, av.error.FFmpegError):
+            raise
         return ""
+    out_stream.width = width
+    out_stream.height = height
+    out_stream.pix_fmt = OUTPUT_PIX_FMT
 
-    api_frames_data = {frame_data['frame_idx']: frame_data for frame_data in api_response_json.get('frames', [])}
+    # 預先將 API 回應整理為陣列，迴圈內只需做陣列切片
+    # 以容器記錄的總幀數限制 frame_idx，超出影片的姿勢資料不會用到
+    kps, scores, valid = build_pose_arrays(api_response_json, in_stream.frames or MAX_POSE_FRAMES)
+    n_pose_frames = len(kps)
 
-    current_frame_idx = 0
-    while True:
-        ret, frame = cap.read()
-        if not ret:
-            break
+    def draw_frame(frame, frame_idx):
+        # to_ndarray() 每次都回傳新的緩衝區，直接就地繪製即可，不需額外複製
+        image = frame.to_ndarray(format="bgr24")
+        if rotation_steps:
+            image = np.ascontiguousarray(np.rot90(image, rotation_steps))
+        if frame_idx < n_pose_frames:
+            draw_pose_arrays(image, kps[frame_idx], scores[frame_idx], valid[frame_idx])
+        return av.VideoFrame.from_ndarray(image, format="bgr24").reformat(
+            width=width, height=height, format=OUTPUT_PIX_FMT
+        )
 
-        predictions_raw = api_frames_data.get(current_frame_idx, {}).get('predictions', [])
+    written_frames = 0
 
-        predictions_for_current_frame = []
-        if predictions_raw and isinstance(predictions_raw, list) and predictions_raw[0] and isinstance(predictions_raw[0], list):
-            predictions_for_current_frame = predictions_raw[0]
-        elif predictions_raw and isinstance(predictions_raw, list) and predictions_raw[0] and isinstance(predictions_raw[0], dict):
-            predictions_for_current_frame = predictions_raw
+    def write_frame(frame):
+        nonlocal written_frames
+        # 依輸出幀率重新編號時間戳
+        frame.pts = written_frames
+        frame.time_base = frame_time_base
+        written_frames += 1
+        out.mux(out_stream.encode(frame))
 
-        rendered_frame = draw_pose_on_frame(
-            frame.copy(),
-            predictions_for_current_frame
-        )
+    # 解碼與編碼在目前執行緒進行，色彩轉換與繪製交由執行緒池並行處理 (numba 繪圖核心會釋放 GIL)；
+    # 以有上限的佇列保存待完成的幀，依序取出寫入以維持幀順序並限制記憶體用量
+    pending = deque()
+    current_frame_idx = 0
+    succeeded = False
+    try:
+        for frame in itertools.chain([first_frame], decoded_frames):
+            pending.append(render_executor.submit(draw_frame, frame, current_frame_idx))
+            current_frame_idx += 1
+            if len(pending) >= RENDER_QUEUE_SIZE:
+                write_frame(pending.popleft().result())
 
-        out.write(rendered_frame)
-        current_frame_idx += 1
+        while pending:
+            write_frame(pending.popleft().result())
+        # 清空編碼器中剩餘的封包
+        out.mux(out_stream.encode())
+        succeeded = True
+    finally:
+        for future in pending:
+            future.cancel()
+        container.close()
+        out.close()
+        # 渲染失敗時刪除未完成的輸出檔案 (編碼錯誤交由呼叫端決定是否改用其他編碼器重試)
+        if not succeeded and os.path.exists(processed_video_path):
+            os.remove(processed_video_path)
 
-    cap.release()
-    out.release()
     print(f"Finished rendering {current_frame_idx} frames and saved to {processed_video_path}.")
     return processed_video_path
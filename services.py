@@ -0,0 +1,89 @@
+import asyncio
+import json
+import os
+import sqlite3
+from contextlib import closing
+
+HISTORY_DB = "history.db"
+HISTORY_FILE = "history.json" # 舊版 JSON 歷史記錄，僅在建立資料庫時匯入一次
+
+# 模擬姿勢資料
+def mock_posture(video_id: str):
+    return {
+        "stride_angle": 42.5,
+        "throwing_angle": 95.3,
+        "arm_symmetry": 88.0,
+        "hip_rotation": 35.2,
+        "elbow_height": 123
+    }
+
+# 模擬模型預測
+def mock_prediction(video_id: str):
+    return {
+        "result": "Good" if video_id.endswith("1") else "Bad",
+        "confidence": 0.92 if video_id.endswith("1") else 0.65
+    }
+
+def _connect_history():
+    return closing(sqlite3.connect(HISTORY_DB))
+
+# 建立歷史資料表，首次啟動時匯入舊版 history.json 的記錄 (於應用啟動時呼叫，並重設記憶體快取)
+def init_history():
+    global history_last_id
+    history_cache["history"] = []
+    history_last_id = 0
+    # 自行管理交易：多個 worker 同時啟動時，以 BEGIN IMMEDIATE 取得寫入鎖後再檢查是否為空表，避免重複匯入
+    with closing(sqlite3.connect(HISTORY_DB, isolation_level=None)) as conn:
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS history ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, timestamp TEXT, filename TEXT, result TEXT)"
+        )
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            is_empty = conn.execute("SELECT COUNT(*) FROM history").fetchone()[0] == 0
+            if is_empty and os.path.exists(HISTORY_FILE):
+                with open(HISTORY_FILE, "r", encoding="utf-8") as f:
+                    records = json.load(f).get("history", [])
+                conn.executemany(
+                    "INSERT INTO history (timestamp, filename, result) VALUES (?, ?, ?)",
+                    [(r.get("timestamp"), r.get("filename"), r.get("result")) for r in records]
+                )
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+def _select_history_since(last_id):
+    with _connect_history() as conn:
+        return conn.execute(
+            "SELECT id, timestamp, filename, result FROM history WHERE id > ? ORDER BY id", (last_id,)
+        ).fetchall()
+
+def _insert_history(timestamp, filename, result):
+    with _connect_history() as conn, conn:
+        conn.execute(
+            "INSERT INTO history (timestamp, filename, result) VALUES (?, ?, ?)",
+            (timestamp, filename, result)
+        )
+
+# 歷史記錄快取於記憶體中；每次讀取只以主鍵範圍查詢補上新增的記錄 (包含其他 worker 寫入的)，不需重讀整張表
+history_cache = {"history": []}
+history_last_id = 0
+history_lock = asyncio.Lock()
+
+# 載入歷史
+async def load_history():
+    global history_last_id
+    async with history_lock:
+        rows = await asyncio.to_thread(_select_history_since, history_last_id)
+        history_cache["history"].extend(
+            {"timestamp": timestamp, "filename": filename, "result": result}
+            for _, timestamp, filename, result in rows
+        )
+        if rows:
+            history_last_id = rows[-1][0]
+    return history_cache
+
+# 寫入歷史 (SQLite 單筆 INSERT，不需重寫整份歷史)
+async def append_history(filename, result):
+    await asyncio.to_thread(_insert_history, "2025-06-22", filename, result)
@@ -0,0 +1,49 @@
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+
+import services
+
+
+class MockPoseApi:
+    """假的姿勢 API：記錄收到的請求，回傳固定結果或丟出指定錯誤"""
+
+    def __init__(self):
+        self.requests = []
+        self.error = None
+        self.response = {"frames": []}
+
+    async def __call__(self, request):
+        # 啟動時的連線預熱
+        if request.method == "HEAD":
+            return httpx.Response(200)
+        if self.error is not None:
+            raise self.error
+        body = await request.aread()
+        self.requests.append((request, body))
+        return httpx.Response(200, json=self.response)
+
+
+@pytest.fixture
+def history_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(services, "HISTORY_DB", str(tmp_path / "history.db"))
+    monkeypatch.setattr(services, "HISTORY_FILE", str(tmp_path / "history.json"))
+    return tmp_path / "history.db"
+
+
+@pytest.fixture
+def pose_api():
+    return MockPoseApi()
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch, history_db, pose_api):
+    # 上傳與輸出目錄都是相對路徑，切到暫存目錄避免弄髒 repo
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "static" / "videos").mkdir(parents=True)
+    (tmp_path / "static" / "processed_videos").mkdir(parents=True)
+
+    import main
+    monkeypatch.setattr(main, "pose_api_client", httpx.AsyncClient(transport=httpx.MockTransport(pose_api)))
+    with TestClient(main.app) as test_client:
+        yield test_client
@@ -0,0 +1,83 @@
+import os
+
+import httpx
+import pytest
+
+# 大於 main.UPLOAD_CHUNK_SIZE (1 MB)，確保分成多塊寫入與轉送
+PAYLOAD = os.urandom(1024 * 1024 * 2 + 12345)
+
+
+def parse_multipart(request, body):
+    """拆解送往姿勢 API 的 multipart 主體，回傳 (part 標頭, part 內容)"""
+    content_type, _, boundary = request.headers["Content-Type"].partition("; boundary=")
+    assert content_type == "multipart/form-data"
+    delimiter = f"--{boundary}".encode()
+    preamble, part, epilogue = body.split(delimiter)
+    assert preamble == b""
+    assert epilogue == b"--\r\n"
+    assert part.startswith(b"\r\n") and part.endswith(b"\r\n")
+    raw_headers, _, content = part[2:-2].partition(b"\r\n\r\n")
+    headers = dict(line.split(": ", 1) for line in raw_headers.decode().split("\r\n"))
+    return headers, content
+
+
+def saved_upload(tmp_path, response):
+    return (tmp_path / response.json()["original_video_url"].lstrip("/")).read_bytes()
+
+
+def test_upload_streams_multipart_to_pose_api(tmp_path, client, pose_api):
+    response = client.post("/upload", files={"file": ("pitch.mp4", PAYLOAD, "video/mp4")})
+
+    assert response.status_code == 200
+    assert response.json()["pose_data"] == pose_api.response
+    [(request, body)] = pose_api.requests
+    assert int(request.headers["Content-Length"]) == len(body)
+    assert "Transfer-Encoding" not in request.headers
+    headers, content = parse_multipart(request, body)
+    assert headers == {
+        "Content-Disposition": 'form-data; name="file"; filename="pitch.mp4"',
+        "Content-Type": "video/mp4",
+    }
+    assert content == PAYLOAD
+    assert saved_upload(tmp_path, response) == PAYLOAD
+
+
+def test_upload_escapes_quote_in_filename(client, pose_api):
+    # httpx 會先將檔名中的引號轉成 %22，這裡手動組出以反斜線跳脫的表單，讓伺服器收到真正的引號
+    boundary = "test-boundary"
+    body = (
+        f'--{boundary}\r\n'
+        f'Content-Disposition: form-data; name="file"; filename="a\\"b.mp4"\r\n'
+        f'Content-Type: video/mp4\r\n\r\n'
+    ).encode() + PAYLOAD + f'\r\n--{boundary}--\r\n'.encode()
+
+    response = client.post(
+        "/upload", content=body, headers={"Content-Type": f"multipart/form-data; boundary={boundary}"}
+    )
+
+    assert response.status_code == 200
+    [(request, body)] = pose_api.requests
+    headers, content = parse_multipart(request, body)
+    assert headers["Content-Disposition"] == 'form-data; name="file"; filename="a%22b.mp4"'
+    assert content == PAYLOAD
+
+
+@pytest.mark.parametrize("filename", ['a"b.mp4', "a\nb.mp4", "a\r\nb.mp4", "a\\b.mp4", "投球.mp4"])
+def test_format_form_param_matches_httpx(client, filename):
+    from main import format_form_param
+    # 換行無法經由表單送達伺服器，直接與 httpx 自身的 multipart 編碼比對
+    request = httpx.Request("POST", "http://pose-api", files={"file": (filename, b"", "video/mp4")})
+    disposition = f'Content-Disposition: form-data; name="file"; filename="{format_form_param(filename)}"\r\n'
+    assert disposition.encode() in request.read()
+    assert "\n" not in format_form_param(filename)
+
+
+def test_upload_saves_file_when_pose_api_unreachable(tmp_path, client, pose_api):
+    pose_api.error = httpx.ConnectError("connection refused")
+
+    response = client.post("/upload", files={"file": ("pitch.mp4", PAYLOAD, "video/mp4")})
+
+    assert response.status_code == 200
+    assert response.json()["pose_data"]["error"] is True
+    assert response.json()["processed_video_url"] == response.json()["original_video_url"]
+    assert saved_upload(tmp_path, response) == PAYLOAD
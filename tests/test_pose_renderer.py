@@ -0,0 +1,142 @@
+from pathlib import Path
+
+import av
+import cv2
+import numpy as np
+import pytest
+
+from pose_renderer import render_video_with_pose
+
+SAMPLE_VIDEO = str(Path(__file__).parent.parent / "static" / "videos" / "0a25fe0f.mp4")
+
+
+def read_video(path):
+    with av.open(path) as container:
+        stream = container.streams.video[0]
+        frames = [frame.to_ndarray(format="bgr24") for frame in container.decode(stream)]
+        duration = float(stream.duration * stream.time_base)
+    return frames, duration
+
+
+def pose_response(frame_indices, keypoint=(100.0, 100.0)):
+    person = {"keypoints": [list(keypoint)] * 17, "keypoint_scores": [0.9] * 17}
+    return {"frames": [{"frame_idx": i, "predictions": [[person]]} for i in frame_indices]}
+
+
+@pytest.mark.parametrize("api_response", [
+    # 姿勢 API 呼叫失敗
+    {"error": True, "message": "Failed to get pose data from external API"},
+    # 只有前段幀有人，尾端幀沒有姿勢資料
+    pose_response(range(100)),
+])
+def test_render_keeps_source_timing(tmp_path, api_response):
+    source_frames, source_duration = read_video(SAMPLE_VIDEO)
+
+    output_path = render_video_with_pose(SAMPLE_VIDEO, api_response, str(tmp_path))
+
+    assert output_path
+    frames, duration = read_video(output_path)
+    assert len(frames) == len(source_frames)
+    assert duration == pytest.approx(source_duration, abs=0.05)
+
+
+def make_rotated_video(path, rotation):
+    with av.open(str(path), "w") as container:
+        stream = container.add_stream("libx264", rate=30)
+        stream.width, stream.height, stream.pix_fmt = 320, 240, "yuv420p"
+        stream.set_display_rotation(rotation)
+        for _ in range(5):
+            image = np.zeros((240, 320, 3), dtype=np.uint8)
+            image[:40, :80] = (0, 0, 255)
+            container.mux(stream.encode(av.VideoFrame.from_ndarray(image, format="bgr24")))
+        container.mux(stream.encode())
+
+
+@pytest.mark.parametrize("rotation", [90, -90, 180])
+def test_render_applies_display_rotation(tmp_path, rotation):
+    source_path = tmp_path / f"rotated_{rotation}.mp4"
+    make_rotated_video(source_path, rotation)
+    # 以 cv2.VideoCapture (自動旋轉) 讀到的畫面作為預期的座標系
+    ok, expected = cv2.VideoCapture(str(source_path)).read()
+    assert ok
+
+    output_path = render_video_with_pose(str(source_path), {"frames": []}, str(tmp_path))
+
+    frames, _ = read_video(output_path)
+    assert frames[0].shape == expected.shape
+    assert np.abs(frames[0].astype(int) - expected.astype(int)).mean() < 3
+
+
+def test_codec_probe_uses_encoder_options(monkeypatch):
+    import pose_renderer
+    # 探測時必須帶入正式編碼的參數，無效參數應使探測失敗並退回 CPU 編碼
+    monkeypatch.setattr(pose_renderer, "GPU_CODEC", "libx264")
+    monkeypatch.setattr(pose_renderer, "GPU_CODEC_OPTIONS", {"preset": "not-a-preset"})
+
+    assert pose_renderer.select_output_codec() == (pose_renderer.CPU_CODEC, pose_renderer.CPU_CODEC_OPTIONS)
+
+
+def test_render_falls_back_to_cpu_when_gpu_encoding_fails(tmp_path, monkeypatch):
+    import pose_renderer
+    # 以無效參數模擬 NVENC 在編碼時失敗 (例如超過工作階段上限)
+    monkeypatch.setattr(pose_renderer, "GPU_CODEC", "libx264")
+    monkeypatch.setattr(pose_renderer, "GPU_CODEC_OPTIONS", {"preset": "not-a-preset"})
+    monkeypatch.setattr(pose_renderer, "OUTPUT_CODEC", "libx264")
+    monkeypatch.setattr(pose_renderer, "OUTPUT_CODEC_OPTIONS", {"preset": "not-a-preset"})
+
+    source_frames, _ = read_video(SAMPLE_VIDEO)
+
+    output_path = render_video_with_pose(SAMPLE_VIDEO, pose_response(range(10)), str(tmp_path))
+
+    assert output_path
+    assert [p.name for p in tmp_path.iterdir()] == [Path(output_path).name]
+    frames, _ = read_video(output_path)
+    assert len(frames) == len(source_frames)
+
+
+def test_draw_handles_far_off_frame_keypoints():
+    import time
+    from pose_renderer import draw_pose_arrays
+
+    frame = np.zeros((240, 320, 3), dtype=np.uint8)
+    kps = np.full((1, 17, 2), 100, dtype=np.int32)
+    scores = np.full((1, 17), 0.9, dtype=np.float32)
+    valid = np.ones(1, dtype=bool)
+    draw_pose_arrays(frame, kps, scores, valid)  # 預先觸發 JIT 編譯
+
+    # NaN 座標轉型後為 INT_MIN；線段須先裁切到畫面內，不能逐點走完約 2^31 步
+    kps[0, 6] = np.iinfo(np.int32).min
+    start = time.perf_counter()
+    draw_pose_arrays(frame, kps, scores, valid)
+    assert time.perf_counter() - start < 1.0
+
+
+def test_build_pose_arrays_accepts_float_frame_idx():
+    from pose_renderer import build_pose_arrays
+
+    response = pose_response([0])
+    response["frames"][0]["frame_idx"] = 3.0
+
+    kps, scores, valid = build_pose_arrays(response)
+
+    assert valid.shape == (4, 1)
+    assert valid[3, 0] and not valid[:3].any()
+
+
+def test_build_pose_arrays_skips_out_of_range_frame_idx():
+    from pose_renderer import build_pose_arrays
+
+    # 異常的超大 frame_idx 不能配置出數 GB 的陣列
+    kps, scores, valid = build_pose_arrays(pose_response([0, -1, 1e9]), max_frames=10)
+
+    assert kps.shape[0] == 1
+    assert valid[0, 0]
+
+
+def test_render_ignores_pose_frames_past_video_end(tmp_path):
+    source_frames, _ = read_video(SAMPLE_VIDEO)
+
+    output_path = render_video_with_pose(SAMPLE_VIDEO, pose_response([0, 10 ** 9]), str(tmp_path))
+
+    frames, _ = read_video(output_path)
+    assert len(frames) == len(source_frames)
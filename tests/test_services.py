@@ -0,0 +1,40 @@
+import json
+import sqlite3
+from contextlib import closing
+
+import services
+
+
+def count_history(db_path):
+    with closing(sqlite3.connect(db_path)) as conn:
+        return conn.execute("SELECT COUNT(*) FROM history").fetchone()[0]
+
+
+def test_init_history_imports_legacy_json_once(history_db):
+    records = [
+        {"timestamp": "2025-06-21", "filename": "a.mp4", "result": "Good"},
+        {"timestamp": "2025-06-22", "filename": "b.mp4", "result": "Bad"},
+    ]
+    with open(services.HISTORY_FILE, "w", encoding="utf-8") as f:
+        json.dump({"history": records}, f)
+
+    # 例如多個 worker 各自啟動
+    services.init_history()
+    services.init_history()
+
+    assert count_history(history_db) == len(records)
+
+
+def test_history_endpoint_returns_rows_from_other_connections(client, history_db):
+    assert client.get("/history").json() == {"history": []}
+
+    # 模擬另一個 worker 寫入
+    with closing(sqlite3.connect(history_db)) as conn, conn:
+        conn.execute(
+            "INSERT INTO history (timestamp, filename, result) VALUES (?, ?, ?)",
+            ("2025-06-22", "other.mp4", "Good")
+        )
+
+    assert client.get("/history").json() == {
+        "history": [{"timestamp": "2025-06-22", "filename": "other.mp4", "result": "Good"}]
+    }